@@ -158,10 +158,31 @@ class ConfigSet(object):
         for g in iter(self._gs):
             yield self._nw._to_config(g)
 
+    def mask_iter(self):
+        """Iterates over configurations as bitmasks; see Network.to_mask().
+        """
+        for g in iter(self._gs):
+            yield self._nw._to_mask_from_forest(g)
+
     def rand_iter(self):
         for g in self._gs.rand_iter():
             yield self._nw._to_config(g)
 
+    def sample_stats(self, n, seed=None, workers=None,
+                     percentiles=(5, 25, 50, 75, 95), bins=10):
+        """Estimates the loss distribution from n random configurations.
+
+        Configurations are drawn uniformly with replacement by a random
+        number generator seeded with seed, so that the result is
+        reproducible on any machine and with any number of workers.
+        Returns a dict of the number of samples, the seed, the mean and
+        the variance of losses, the given percentiles, and a histogram
+        as a pair of counts and bin edges.  Percentiles and the
+        histogram are computed from at most 100000 evenly spaced
+        samples, which keeps memory flat for large n.
+        """
+        return self._nw._sample_stats(self._gs, n, seed, workers, percentiles, bins)
+
     def min_iter(self, weights=None):
         if weights is not None:
             weights = self._conv_weights(weights)
@@ -181,25 +202,25 @@ class ConfigSet(object):
         return weights2
 
     def __contains__(self, config_or_switch):
-        if isinstance(config_or_switch, list):
+        if isinstance(config_or_switch, (list, int)):
             return self._nw._to_forest(config_or_switch) in self._gs
         else:
             return self._nw._to_edge(config_or_switch) in self._gs
 
     def add(self, config_or_switch):
-        if isinstance(config_or_switch, list):
+        if isinstance(config_or_switch, (list, int)):
             self._gs.add(self._nw._to_forest(config_or_switch))
         else:
             self._gs.add(self._nw._to_edge(config_or_switch))
 
-    def remove(self, config):
-        if isinstance(config_or_switch, list):
+    def remove(self, config_or_switch):
+        if isinstance(config_or_switch, (list, int)):
             self._gs.remove(self._nw._to_forest(config_or_switch))
         else:
             self._gs.remove(self._nw._to_edge(config_or_switch))
 
-    def discard(self, config):
-        if isinstance(config_or_switch, list):
+    def discard(self, config_or_switch):
+        if isinstance(config_or_switch, (list, int)):
             self._gs.discard(self._nw._to_forest(config_or_switch))
         else:
             self._gs.discard(self._nw._to_edge(config_or_switch))
@@ -236,7 +257,7 @@ class ConfigSet(object):
     def including(self, obj):
         if isinstance(obj, ConfigSet):
             obj = obj._gs
-        elif isinstance(obj, list):
+        elif isinstance(obj, (list, int)):
             obj = self._nw._to_forest(obj)
         else:
             obj = self._nw._to_edge(obj)
@@ -245,7 +266,7 @@ class ConfigSet(object):
     def excluding(self, obj):
         if isinstance(obj, ConfigSet):
             obj = obj._gs
-        elif isinstance(obj, list):
+        elif isinstance(obj, (list, int)):
             obj = self._nw._to_forest(obj)
         else:
             obj = self._nw._to_edge(obj)
@@ -254,7 +275,7 @@ class ConfigSet(object):
     def included(self, obj):
         if isinstance(obj, ConfigSet):
             obj = obj._gs
-        elif isinstance(obj, list):
+        elif isinstance(obj, (list, int)):
             obj = self._nw._to_forest(obj)
         else:
             raise TypeError(obj)
@@ -20,7 +20,9 @@
 """Data converter for DNET.
 """
 
+from collections import deque
 from dnet.unionfind import UnionFind
+import os
 import yaml
 
 
@@ -34,91 +36,146 @@ class FukuiTepcoConverter(object):
                        'root'     : dir + '/root.dat'}
 
     def convert(self):
-        switch_numbers = set()
+        return yaml.dump(self.to_dict())
+
+    def to_dict(self):
+        topology = self._read_topology()
+        return self._to_dict(topology, self._read_loads(self._files['load']))
+
+    def snapshots(self, dir):
+        """Yields network objects for each load snapshot in the directory.
+
+        The topology is read just once and shared by all the objects,
+        while section loads are replaced by those in each snapshot
+        file (LNewSL format, taken in file name order).
+        """
+        topology = self._read_topology()
+        for file in self._snapshot_files(dir):
+            yield self._to_dict(topology, self._read_loads(file))
+
+    def read_loads(self, file_or_dir=None):
+        """Reads section loads of one or more snapshots.
+
+        Returns a tuple of section names and loads, which are indexed
+        by (snapshot, section, phase) as complex numbers.  If a
+        directory is given, each file in it is regarded as a snapshot.
+        """
+        if file_or_dir is None:
+            file_or_dir = self._files['load']
+        if os.path.isdir(file_or_dir):
+            files = self._snapshot_files(file_or_dir)
+        else:
+            files = [file_or_dir]
+        switch_numbers = self._read_switch_numbers()
+        numbers = None
+        loads = []
+        for file in files:
+            l = self._read_loads(file)
+            if numbers is None:
+                numbers = sorted(set(l) - switch_numbers,
+                                 key=lambda s: 'section_%04d' % s)
+            assert len(l) - len(switch_numbers & set(l)) == len(numbers), file
+            loads.append([[complex(l[s][2*i], l[s][2*i + 1]) for i in range(3)]
+                          for s in numbers])
+        return ['section_%04d' % s for s in numbers], loads
+
+    def _snapshot_files(self, dir):
+        return [os.path.join(dir, f) for f in sorted(os.listdir(dir))
+                if os.path.isfile(os.path.join(dir, f))]
+
+    def _read_switch_numbers(self):
         with open(self._files['switch']) as f:
-            for line in f:
-                for s in line.split():
-                    switch_numbers.add(int(s))
+            return set(map(int, f.read().split()))
+
+    def _read_loads(self, file):
+        cols = _read_columns(file, 10)
+        values = zip(*[map(float, c) for c in cols[4:]])
+        return dict(zip(map(int, cols[1]), map(list, values)))
+
+    def _read_topology(self):
+        switch_numbers = self._read_switch_numbers()
 
         switches = set()
         sections = set()
         nodes = {}
-        with open(self._files['topology']) as f:
-            for line in f:
-                s, m, n, _ = line.split()
-                s, m, n = int(s), int(m), int(n)
-                if m not in nodes: nodes[m] = set()
-                if n not in nodes: nodes[n] = set()
-                nodes[m].add(s)
-                nodes[n].add(s)
-                if s in switch_numbers:
-                    switches.add(s)
-                else:
-                    sections.add(s)
-
-        loads = {}
-        with open(self._files['load']) as f:
-            for line in f:
-                _, s, m, n, ur, ui, vr, vi, wr, wi = line.split()
-                loads[int(s)] = [float(ur), float(ui), float(vr), float(vi), \
-                                     float(wr), float(wi)]
+        cols = _read_columns(self._files['topology'], 4)
+        for s, m, n in zip(*[map(int, c) for c in cols[:3]]):
+            if m not in nodes: nodes[m] = set()
+            if n not in nodes: nodes[n] = set()
+            nodes[m].add(s)
+            nodes[n].add(s)
+            if s in switch_numbers:
+                switches.add(s)
+            else:
+                sections.add(s)
 
         impedances = {}
-        with open(self._files['impedance']) as f:
-            for line in f:
-                s, p, m, n, ur, ui, vr, vi, wr, wi = line.split()
-                s = int(s)
-                if p == '0':
-                    impedances[s] = [float(ur), float(ui)]
-                elif p == '1':
-                    impedances[s].extend([float(vr), float(vi)])
-                else:
-                    impedances[s].extend([float(wr), float(wi)])
+        cols = _read_columns(self._files['impedance'], 10)
+        for s, p, ur, ui, vr, vi, wr, wi in zip(map(int, cols[0]), cols[1],
+                                                *[map(float, c) for c in cols[4:]]):
+            if p == '0':
+                impedances[s] = [ur, ui]
+            elif p == '1':
+                impedances[s].extend([vr, vi])
+            else:
+                impedances[s].extend([wr, wi])
 
         roots = set()
-        with open(self._files['root']) as f:
-            for line in f:
-                _, n, lu, lv, lw, ir, ii = line.split()
-                n = int(n)
-                nodes[n].add(-n)
-                sections.add(-n)
-                roots.add(-n)
-                loads[-n] = [float(lu), 0, float(lv), 0, float(lw), 0]
-                impedances[-n] = [float(ir), float(ii)] * 3
+        root_loads = {}
+        cols = _read_columns(self._files['root'], 7)
+        for n, lu, lv, lw, ir, ii in zip(map(int, cols[1]),
+                                         *[map(float, c) for c in cols[2:]]):
+            nodes[n].add(-n)
+            sections.add(-n)
+            roots.add(-n)
+            root_loads[-n] = [lu, 0, lv, 0, lw, 0]
+            impedances[-n] = [ir, ii] * 3
+
+        incidence = {}  # element -> nodes the element is connected to
+        for n, ns in nodes.items():
+            for s in ns:
+                if s not in incidence: incidence[s] = []
+                incidence[s].append(n)
 
         def find_neighbors(s):
             neighbors = []
-            for ns in list(nodes.values()):
-                if s in ns:
-                    neighbors.extend(ns)
+            for n in incidence[s]:
+                neighbors.extend(nodes[n])
             return set(neighbors) - set([s])
 
-        assert len([t for s in sections if s < 0 for t in find_neighbors(s) if t in switches]) == 0, \
+        def traverse(s, elems=None):
+            visited = [s]
+            visited_set = set([s])
+            queue = deque()
+            queued = set()
+            while True:
+                neighbors = set()
+                for t in find_neighbors(s):
+                    if elems is None or t in elems:
+                        neighbors.add(t)
+                new_elems = neighbors - visited_set - queued - roots
+                queue.extend(new_elems)
+                queued.update(new_elems)
+                if not queue: break
+                s = queue.popleft()
+                queued.remove(s)
+                visited.append(s)
+                visited_set.add(s)
+            return visited
+
+        assert len([t for s in roots for t in find_neighbors(s) if t in switches]) == 0, \
             'root sections must be connected to a junction, not a switch'
 
-        uf = UnionFind()
-        uf.insert_objects(switches | sections - roots)
-        for s in sorted(switches | sections - roots):
-            neighbors = set()
-            for n in [m for m in list(nodes.values()) if s in m]:
-                if [t for t in n if t in roots] == []:
-                    for t in n:
-                        neighbors.add(t)
-            for t in sorted(neighbors - set([s])):
-                uf.union(s, t)
-
-        visited = []
-        queue = []
-        s = sorted(sections - roots)[0]
-        while True:
-            if s in visited: continue
-            visited.append(s)
-            neighbors = set()
-            for t in find_neighbors(s):
-                neighbors.add(t)
-            queue.extend(neighbors - set(visited) - set(queue) - roots)
-            if queue == []: break
-            s, queue = queue[0], queue[1:]
+        uf = UnionFind(switches | sections - roots)
+        elems1, elems2 = [], []
+        for ns in nodes.values():
+            if ns.isdisjoint(roots):
+                ns = sorted(ns)
+                elems1.extend([ns[0]] * (len(ns) - 1))
+                elems2.extend(ns[1:])
+        uf.union_pairs(elems1, elems2)
+
+        visited = traverse(min(sections - roots))
         assert len(visited) == len(switches | sections - roots)
 
         i = 1
@@ -132,27 +189,13 @@ class FukuiTepcoConverter(object):
         assert sum([len(c[1]) for c in list(comps.values())]) == len(switches | sections - roots)
 
         sorted_switches = []
-        for i in range(1, len(comps) + 1):
-            comp = [c for c in list(comps.values()) if c[0] == i][0]
-            visited = []
-            queue = []
-            s = sorted(comp[1])[0]
-            while s:
-                if s in visited: continue
+        for i, comp in sorted(comps.values(), key=lambda c: c[0]):
+            for s in traverse(min(comp), comp):
                 if s in switches:
                     sorted_switches.append(s)
-                visited.append(s)
-                neighbors = set()
-                for t in find_neighbors(s):
-                    if t in comp[1]:
-                        neighbors.add(t)
-                queue.extend(neighbors - set(visited) - set(queue) - roots)
-                if queue == []: break
-                s, queue = queue[0], queue[1:]
         assert len(sorted_switches) == len(switches)
 
-        obj = { 'nodes': [], 'switches': {}, 'sections': {} }
-
+        obj_nodes = []
         for n in sorted(nodes):
             ss = []
             for s in nodes[n]:
@@ -160,20 +203,29 @@ class FukuiTepcoConverter(object):
                     ss.append('switch_%04d' % s)
                 else:
                     ss.append('section_%04d' % s)
-            obj['nodes'].append(sorted(ss))
+            obj_nodes.append(sorted(ss))
 
-        obj['switches'] = ['switch_%04d' % s for s in sorted_switches]
-#        for s in sorted(switches):
-#            c = uf.find(s)
-#            i = comps[c][0]
+        obj_switches = ['switch_%04d' % s for s in sorted_switches]
+        sorted_sections = sorted(sections, key=lambda s: 'section_%04d' % s)
 
-        for s in sorted(sections):
-#            c = uf.find(s)
-#            i = comps[c][0] if c > 0 else 0
+        return obj_nodes, obj_switches, sorted_sections, impedances, root_loads
+
+    def _to_dict(self, topology, loads):
+        nodes, switches, sections, impedances, root_loads = topology
+        obj = { 'nodes': nodes, 'switches': switches, 'sections': {} }
+        for s in sections:
             obj['sections']['section_%04d' % s] = {
-                'load'      : loads[s],
-                'impedance' : impedances[s],
+                'load'      : list(root_loads[s] if s < 0 else loads[s]),
+                'impedance' : list(impedances[s]),
                 'substation': s < 0,
             }
+        return obj
+
 
-        return yaml.dump(obj)
+def _read_columns(file, num_columns):
+    """Reads a whitespace-separated table at once, and returns its
+    columns as lists of strings."""
+    with open(file) as f:
+        fields = f.read().split()
+    assert len(fields) % num_columns == 0, file
+    return [fields[i::num_columns] for i in range(num_columns)]
@@ -22,11 +22,21 @@
 
 from dnet.configset import ConfigSet
 from dnet.unionfind import UnionFind
-from dnet.util import flatten, is_tree
+from dnet.util import csr
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Mapping
 from itertools import product
 from graphillion import GraphSet
 from math import sqrt
+import hashlib
+import multiprocessing
 import networkx as nx
+import os
+import pickle
+import random
+import sys
+import tempfile
 import yaml
 
 
@@ -40,75 +50,221 @@ class Graph(object):
         self.roots = set()
         self._switch2edge = {}
         self._edge2switch = {}
+        self._edge2bit = {}
         self._section2vertex = {}
         self._vertex2sections = {}
 
 
-class Node(object):
-    """Represents a ZDD node.
+class SectionView(Mapping):
+    """Is a read-only view of the section data, keyed by section names.
+
+    The network stores section data in arrays indexed by section IDs,
+    and the view builds the dict of load, impedance, and substation
+    flag only for the accessed section.
+    """
+
+    def __init__(self, nw):
+        self._nw = nw
+
+    def __getitem__(self, s):
+        if s not in self:
+            raise KeyError(s)
+        i = self._nw._elem_ids[s]
+        return {'load': list(self._nw._loads[i]),
+                'impedance': list(self._nw._impedances[i]),
+                'substation': bool(self._nw._substations[i])}
+
+    def __contains__(self, s):
+        return self._nw._elem_ids.get(s, self._nw._num_sections) < self._nw._num_sections
+
+    def __iter__(self):
+        return iter(self._nw._elems[:self._nw._num_sections])
+
+    def __len__(self):
+        return self._nw._num_sections
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class ZDD(object):
+    """Represents a ZDD read from a dump of GraphSet.
+
+    Nodes are numbered densely in parallel arrays of variables, low and
+    high children, and IDs in the dump; 0 and 1 are the B and T
+    terminals, whose variable is larger than any other.
+    """
+
+    def __init__(self, s, num_vars):
+        self.var = array('i', [num_vars + 1, num_vars + 1])
+        self.lo = array('i', [0, 1])
+        self.hi = array('i', [0, 1])
+        self.ids = array('q', [-1, -1])
+        self.root = 0
+        indices = {'B': 0, 'T': 1}
+        for line in _split_lines(s):
+            fields = line.split()
+            if len(fields) != 4:
+                if line.startswith('.'):
+                    break
+                elif fields:  # a terminal alone
+                    self.root = indices[fields[0]]
+                continue
+            n, v, l, h = fields
+            self.root = indices[n] = len(self.var)
+            self.var.append(int(v))
+            self.lo.append(indices[l])
+            self.hi.append(indices[h])
+            self.ids.append(int(n))
+
+    def label(self, n):
+        return 'B' if n == 0 else 'T' if n == 1 else str(self.ids[n])
+
+    def count_paths(self):
+        # the number of paths to T from each node
+        count = [0, 1]
+        for n in range(2, len(self.var)):
+            count.append(count[self.lo[n]] + count[self.hi[n]])
+        return count
+
+
+class Tree(object):
+    """Represents a radial tree fed by a root section.
+
+    Section IDs are ordered from the root, and the other lists are
+    indexed by the positions in the order; the parent of a section
+    always precedes it.
     """
 
-    def __init__(self, str):
-        n, v, l, h = str.split()
-        self.n = n
-        self.v = int(v)
-        self.l = l
-        self.h = h
+    def __init__(self, root):
+        self.root = root
+        self.order = [root]
+        self.parents = [-1]
+        self.num_children = [0]
+        self.current = []
+        self.positions = { root: 0 }
 
 
 class SearchSpace(object):
     """Represents a search space for the optimization.
+
+    The search space is a layered DAG of ZDD nodes, one layer for each
+    component.  Edges are stored in arrays with closed switches given
+    by bitmasks shifted by the lowest switch in the component, and the
+    networkx graph is built on request.
     """
 
-    def __init__(self):
-        self.graph = nx.DiGraph()
+    def __init__(self, zdd=None, switches=None):
         self.start = None
         self.end = None
+        self._zdd = zdd
+        self._switches = switches
+        self._sources = array('i')
+        self._targets = array('i')
+        self._weights = array('d')
+        self._configs = []
+        self._offsets = array('i')
+        self._edges = {}  # edge index for each pair of nodes
+        self._graph = None
+
+    @property
+    def graph(self):
+        if self._graph is None:
+            self._graph = nx.DiGraph()
+            for k in range(len(self._sources)):
+                config = set([self._switches[i] for i in _bits(self.config(k))])
+                self._graph.add_edge(self._zdd.label(self._sources[k]),
+                                     self._zdd.label(self._targets[k]),
+                                     weight=self._weights[k], config=config)
+        return self._graph
+
+    def add_edge(self, n, m, weight, config, offset=0):
+        # the lightest edge is kept between the same nodes
+        k = self._edges.get((n, m))
+        if k is None:
+            self._edges[(n, m)] = len(self._sources)
+            self._sources.append(n)
+            self._targets.append(m)
+            self._weights.append(weight)
+            self._configs.append(config)
+            self._offsets.append(offset)
+        elif not weight > self._weights[k]:
+            self._weights[k] = weight
+            self._configs[k] = config
+            self._offsets[k] = offset
+        self._graph = None
+
+    def config(self, k):
+        """Returns the bitmask of closed switches on the k-th edge."""
+        return self._configs[k] << self._offsets[k]
+
+    def shortest_path(self, start, end):
+        """Returns the edge indices on the shortest path.
+
+        Edges are added layer by layer, and a node has outgoing edges
+        other than self loops in only one layer, so that a single
+        relaxation pass in the insertion order is exact.
+        """
+        dist = {start: 0.0}
+        pred = {}
+        for k in range(len(self._sources)):
+            n, m = self._sources[k], self._targets[k]
+            if n == m or n not in dist:
+                continue
+            d = dist[n] + self._weights[k]
+            if m not in dist or d < dist[m]:
+                dist[m] = d
+                pred[m] = k
+        if end not in dist:
+            raise nx.NetworkXNoPath('no path to %s' % self._zdd.label(end))
+        path = []
+        while end != start:
+            path.append(pred[end])
+            end = self._sources[pred[end]]
+        return path[::-1]
 
 
 class Network(object):
     """Represents a distribution network.
     """
 
-    def __init__(self, file_or_dir, format=None):
-        if format == 'fukui-tepco':
-            from dnet.converter import FukuiTepcoConverter
-            obj = yaml.load(FukuiTepcoConverter(file_or_dir).convert())
-        else:
-            obj = yaml.load(open(file_or_dir))
-        self.nodes = obj['nodes']
-        self.sections = obj['sections']
-        self.switches = obj['switches']
-        self._switch_set = set(self.switches)  # for fast membership query
-        for s in list(self.sections.values()):
-            l = s['load']
-            z = s['impedance']
-            s['load'] = []
-            s['impedance'] = []
-            for i in range(Network.NUM_PHASES):
-                s['load'].append(l[2*i] + l[2*i + 1]*1j)
-                s['impedance'].append(z[2*i] + z[2*i + 1]*1j)
-        if [l for s in list(self.sections.values()) for l in s['load'] if l.real < 0]:
-            msg = 'Warning: it is assumed that section loads are non-negative'
-            sys.stderr.write(msg + '\n')
-        self._neighbor_cache = {}
-        self.graph = self._build_graph()
+    def __init__(self, file_or_dir, format=None, cache_dir=None):
+        self._cache_dir = cache_dir
+        digest = None
+        if cache_dir is not None and not isinstance(file_or_dir, dict):
+            digest = self._digest(file_or_dir, format)
+        if digest is None or not self._load_compiled(cache_dir, digest):
+            if isinstance(file_or_dir, dict):
+                obj = file_or_dir
+            elif format == 'fukui-tepco':
+                from dnet.converter import FukuiTepcoConverter
+                obj = FukuiTepcoConverter(file_or_dir).to_dict()
+            else:
+                with open(file_or_dir) as f:
+                    obj = yaml.safe_load(f)
+            self._compile(obj)
+            if digest is not None:
+                self._save_compiled(cache_dir, digest)
         self.search_space = SearchSpace()
         self._elec_feasible_configs = {}
+        self._loss_cache = OrderedDict()
+        self._loss_cache_hits = 0
+        self._loss_cache_misses = 0
 
-    def enumerate(self, topology_constraints_only=None, suspicious_cut=[]):
+    def enumerate(self, topology_constraints_only=None, suspicious_cut=[],
+                  workers=None):
         gs = self._enumerate_forests(suspicious_cut)
         if not topology_constraints_only:
+            self._find_elec_feasible_configs(workers)
             for root in self._get_root_sections():
-                if root not in self._elec_feasible_configs:
-                    self._elec_feasible_configs[root] = self._enumerate_trees(root)
                 gs &= self._elec_feasible_configs[root]
         return ConfigSet(self, gs)
 
     def loss(self, config, is_optimal=False):
+        closed = self.to_mask(config)
         loss = 0
-        for s in self._get_root_sections():
-            loss += self._calc_loss(s, set(config), set())
+        for r in self._root_ids:
+            loss += self._calc_loss(r, closed)
 
         if not is_optimal:
             return loss
@@ -116,49 +272,115 @@ class Network(object):
             lower_bound = 0  # theoretical lower bound in root sections
             for i in range(Network.NUM_PHASES):
                 total_loads = 0.0
-                for s in self.sections:
-                    total_loads += self.sections[s]['load'][i]
+                for load in self._loads:
+                    total_loads += load[i]
                 resistance_sum = 0.0
-                for s in self._get_root_sections():
-                    resistance_sum += 1 / self.sections[s]['impedance'][i].real
-                for root in self._get_root_sections():
-                    resistance = self.sections[root]['impedance'][i].real
+                for r in self._root_ids:
+                    resistance_sum += 1 / self._impedances[r][i].real
+                for r in self._root_ids:
+                    resistance = self._impedances[r][i].real
                     current = total_loads / (resistance * resistance_sum)
                     lower_bound += self._do_calc_loss(current, resistance)
 
             comp_loss = 0  # loss without root sections
-            for s in self._get_root_sections():
-                comp_loss += self._calc_loss(s, set(config), set(), no_root=True)
+            for r in self._root_ids:
+                comp_loss += self._calc_loss(r, closed, no_root=True)
 
             return loss, lower_bound + comp_loss
 
-    def optimize(self, gs):
+    def to_mask(self, config):
+        """Returns the bitmask of a configuration.
+
+        The i-th bit stands for the i-th switch in self.switches being
+        closed.  A bitmask is returned as it is.
+        """
+        if isinstance(config, int):
+            return config
+        mask = 0
+        for s in config:
+            mask |= 1 << (self._elem_ids[s] - self._num_sections)
+        return mask
+
+    def from_mask(self, mask):
+        """Returns the list of closed switches in a bitmask.
+        """
+        return [self.switches[i] for i in _bits(mask)]
+
+    def evaluate_many(self, configs):
+        """Evaluates configurations in a batch.
+
+        Configurations are lists of closed switches or bitmasks.
+        Returns four lists for the given configurations: losses,
+        feasibility flags, the lowest voltages at the middle of leaf
+        sections, and the peak currents from substations.  Numbers are
+        nan for configurations with a loop.
+        """
+        cache = {}  # trees shared by configurations are evaluated once
+        losses, feasibility, voltages, currents = [], [], [], []
+        for config in configs:
+            loss, feasible, voltage, current = \
+                self._evaluate(self.to_mask(config), cache)
+            losses.append(loss)
+            feasibility.append(feasible)
+            voltages.append(voltage)
+            currents.append(current)
+        return losses, feasibility, voltages, currents
+
+    def optimize(self, gs, workers=None):
         comps = self._find_components()
 
-        self._zdd = { 'B': Node('B %d B B ' % (len(self.switches) + 1)),
-                      'T': Node('T %d T T ' % (len(self.switches) + 1)) }
-        for line in gs.dumps().split('\n'):
-            if line.startswith('.'):
-                break
-            n = Node(line)
-            self._zdd[n.n] = n
-            self.search_space.start = n.n
+        self._zdd = ZDD(gs.dumps(), len(self.switches))
+        self.search_space = SearchSpace(self._zdd, self.switches)
+        self.search_space.start = self._zdd.label(self._zdd.root)
 
-        entries = set([self.search_space.start])
+        layers = []
+        entries = set([self._zdd.root])
         for comp in comps:
-            entries = self._rebuild(entries, comp)
+            layer = self._rebuild(entries, comp)
+            layers.append(layer)
+            entries = layer[3]
+
+        # losses are evaluated for unique configurations in each
+        # component, so the result does not depend on the number of workers
+        losses = self._calc_layer_losses(layers, workers)
+        for (comp_roots, offset, rows, _), loss_cache in zip(layers, losses):
+            for n, masks, exits in rows:
+                for closed, m in zip(masks, exits):
+                    self.search_space.add_edge(n, m, loss_cache[closed], closed, offset)
 
         self.search_space.end = 'T'
 
-        path = nx.dijkstra_path(self.search_space.graph, self.search_space.start,
-                                self.search_space.end)
+        closed = 0
+        for k in self.search_space.shortest_path(self._zdd.root, 1):
+            closed |= self.search_space.config(k)
+
+        return sorted(self.from_mask(closed))
 
-        closed_switches = []
-        for i in range(len(path) - 1):
-            x, y = path[i], path[i + 1]
-            closed_switches.extend(list(self.search_space.graph[x][y]['config']))
+    def update_loads(self, loads):
+        """Replaces loads of the given sections.
 
-        return sorted(set(closed_switches))
+        Loads are given by six values for each section as in the data
+        file.  Feasible configurations found so far are discarded only
+        for the substations which can reach the changed sections, while
+        the component losses cached by optimize() are all discarded.
+        """
+        self._update_sections(self._loads, loads)
+
+    def update_impedances(self, impedances):
+        """Replaces impedances of the given sections.
+
+        See update_loads() for the format and the invalidation.
+        """
+        self._update_sections(self._impedances, impedances)
+
+    def loss_cache_info(self):
+        """Returns statistics of the component loss cache.
+
+        optimize() keeps losses of components for each configuration
+        across calls, up to LOSS_CACHE_SIZE entries in the LRU order.
+        """
+        return {'hits': self._loss_cache_hits, 'misses': self._loss_cache_misses,
+                'size': len(self._loss_cache), 'max_size': Network.LOSS_CACHE_SIZE}
 
     def unrestorable_cuts(self, max_cut_size):
         unrestorable_cuts = set()
@@ -176,6 +398,300 @@ class Network(object):
                         unrestorable_cuts.add(unrestorable_cut)
         return sorted(unrestorable_cuts)
 
+    def _compile(self, obj):
+        self.nodes = obj['nodes']
+        self.switches = obj['switches']
+        self._switch_set = set(self.switches)  # for fast membership query
+        # elements are numbered with sections first, followed by switches
+        self._elems = sorted(obj['sections']) + self.switches
+        self._elem_ids = dict((e, i) for i, e in enumerate(self._elems))
+        self._num_sections = len(obj['sections'])
+        self._loads = []  # tuple of complex loads for each section ID
+        self._impedances = []
+        self._substations = bytearray()
+        for name in self._elems[:self._num_sections]:
+            s = obj['sections'][name]
+            self._loads.append(self._to_phases(s['load']))
+            self._impedances.append(self._to_phases(s['impedance']))
+            self._substations.append(bool(s['substation']))
+        self._root_ids = [i for i in range(self._num_sections) if self._substations[i]]
+        self.sections = SectionView(self)
+        if [l for load in self._loads for l in load if l.real < 0]:
+            msg = 'Warning: it is assumed that section loads are non-negative'
+            sys.stderr.write(msg + '\n')
+        self._build_index()
+        self.graph = self._build_graph()
+
+    def _to_phases(self, values):
+        # six values in the data file make three complex values
+        return tuple([values[2*i] + values[2*i + 1]*1j
+                      for i in range(Network.NUM_PHASES)])
+
+    def _update_sections(self, values, updates):
+        changed = set()
+        for s in updates:
+            if s not in self.sections:
+                raise KeyError(s)
+            values[self._elem_ids[s]] = self._to_phases(updates[s])
+            changed.add(s)
+        # feasible configurations are kept for roots which cannot reach
+        # the changed sections, while losses in the search space are stale
+        for root in list(self._elec_feasible_configs.keys()):
+            if self._find_reachable_elems(root) & changed:
+                del self._elec_feasible_configs[root]
+        self._loss_cache.clear()
+        self.search_space = SearchSpace()
+
+    def _build_index(self):
+        self._node_ptr, self._node_elems = \
+            csr([[self._elem_ids[e] for e in n] for n in self.nodes])
+        incidence = [[] for e in self._elems]
+        for k in range(len(self.nodes)):
+            for i in self._node_elems[self._node_ptr[k]:self._node_ptr[k + 1]]:
+                incidence[i].append(k)
+        self._elem_ptr, self._elem_nodes = csr(incidence)
+        adjacency = []
+        for i, ks in enumerate(incidence):
+            neighbors = set()
+            for k in ks:
+                neighbors.update(self._node_elems[self._node_ptr[k]:self._node_ptr[k + 1]])
+            neighbors.discard(i)
+            adjacency.append(sorted(neighbors))
+        self._adj_ptr, self._adj = csr(adjacency)
+        # links of each section to sections in the same junction, or to
+        # sections beyond switches; junctions are grouped, so that a loop
+        # is found as a switch into an energized group
+        n = self._num_sections
+        links = [[] for i in range(n)]
+        for i in range(n):
+            for j in adjacency[i]:
+                if j < n:
+                    links[i].append((j, -1))
+                else:
+                    links[i].extend([(k, j) for k in adjacency[j] if k != i])
+        self._groups = array('i', [-1] * n)
+        self._num_groups = 0
+        for i in range(n):
+            if self._groups[i] >= 0:
+                continue
+            self._groups[i] = self._num_groups
+            queue = deque([i])
+            while queue:
+                j = queue.popleft()
+                for t, w in links[j]:
+                    if w < 0 and self._groups[t] < 0:
+                        self._groups[t] = self._num_groups
+                        queue.append(t)
+            self._num_groups += 1
+        self._link_ptr, self._link_sections = csr([[t for t, w in l] for l in links])
+        self._link_switches = csr([[w for t, w in l] for l in links])[1]
+        self._link_groups = csr([[self._groups[t] for t, w in l] for l in links])[1]
+        # switches around each junction group and around each switch,
+        # given by bitmasks
+        self._group_switches = [0] * self._num_groups
+        for i in range(n):
+            for j in adjacency[i]:
+                if j >= n:
+                    self._group_switches[self._groups[i]] |= 1 << (j - n)
+        self._switch_neighbors = []
+        for j in range(n, len(self._elems)):
+            mask = 0
+            for i in adjacency[j]:
+                mask |= self._group_switches[self._groups[i]]
+            self._switch_neighbors.append(mask & ~(1 << (j - n)))
+
+    def _digest(self, file_or_dir, format):
+        if format == 'fukui-tepco':
+            files = [os.path.join(file_or_dir, f) for f in
+                     ('sw_list.dat', 'SWed.dat', 'LNewSL.dat', 'LNewZ.dat', 'root.dat')]
+        else:
+            files = [file_or_dir]
+        h = hashlib.sha1(('%s %d\n' % (format, Network.NUM_PHASES)).encode())
+        for file in files:
+            with open(file, 'rb') as f:
+                h.update(f.read())
+        return h.hexdigest()
+
+    def _compiled_path(self, cache_dir, digest):
+        return os.path.join(cache_dir, digest + '.dnetc')
+
+    def _load_compiled(self, cache_dir, digest):
+        # any failure, e.g. a class renamed in another version, just
+        # makes the network compiled again
+        try:
+            with open(self._compiled_path(cache_dir, digest), 'rb') as f:
+                version, digest2, state = pickle.load(f)
+        except Exception:
+            return False
+        if version != Network.COMPILED_VERSION or digest2 != digest:
+            return False
+        self._set_state(state)
+        return True
+
+    def _save_compiled(self, cache_dir, digest):
+        data = pickle.dumps((Network.COMPILED_VERSION, digest, self._get_state()),
+                            pickle.HIGHEST_PROTOCOL)
+        _write_atomically(self._compiled_path(cache_dir, digest), data)
+
+    def _get_state(self):
+        return dict((a, getattr(self, a)) for a in Network._COMPILED_ATTRS)
+
+    def _set_state(self, state):
+        self.__dict__.update(state)
+        self.sections = SectionView(self)
+        GraphSet.set_universe(self.graph.edges, traversal='as-is')
+
+    def _find_elec_feasible_configs(self, workers):
+        roots = [r for r in sorted(self._get_root_sections())
+                 if r not in self._elec_feasible_configs]
+        digests = {}
+        if self._cache_dir is not None:
+            for root in roots:
+                digests[root] = self._root_digest(root)
+                gs = self._load_elec_feasible_configs(digests[root])
+                if gs is not None:
+                    self._elec_feasible_configs[root] = gs
+            roots = [r for r in roots if r not in self._elec_feasible_configs]
+        if workers is not None and workers > 1 and len(roots) > 1:
+            self._enumerate_trees_in_parallel(roots, workers)
+        for root in roots:
+            if root not in self._elec_feasible_configs:
+                self._elec_feasible_configs[root] = self._enumerate_trees(root)
+            if root in digests:
+                self._save_elec_feasible_configs(digests[root],
+                                                 self._elec_feasible_configs[root])
+
+    def _root_digest(self, root):
+        # feasible configurations of a root depend on the enumeration code,
+        # the switch order, the electrical limits, and the sections
+        # reachable without crossing switches next to the other roots
+        border_switches = self._find_border_switches(root)
+        h = hashlib.sha1()
+        h.update(repr((Network.ENUMERATION_VERSION,
+                       Network.MAX_CURRENT, Network.SENDING_VOLTAGE,
+                       Network.VOLTAGE_RANGE, Network.NUM_PHASES,
+                       self.switches, sorted(self.from_mask(border_switches)))).encode())
+        for s in sorted(self._find_reachable_elems(root, border_switches)):
+            h.update(repr((s, self._find_nodes(s))).encode())
+            if s in self.sections:
+                i = self._elem_ids[s]
+                h.update(repr((self._loads[i], self._impedances[i],
+                               self._substations[i])).encode())
+        return h.hexdigest()
+
+    def _find_reachable_elems(self, root, border_switches=None):
+        # elements reachable from the root without crossing switches next
+        # to the other roots
+        if border_switches is None:
+            border_switches = self._find_border_switches(root)
+        border_switches = set(self.from_mask(border_switches))
+        elems = set([root])
+        queue = deque([root])
+        while queue:
+            s = queue.popleft()
+            if s in border_switches:
+                continue
+            for t in self._find_neighbors(s) - elems:
+                elems.add(t)
+                queue.append(t)
+        return elems
+
+    def _load_elec_feasible_configs(self, digest):
+        # a broken or foreign file is just a cache miss
+        try:
+            with open(os.path.join(self._cache_dir, digest + '.gs')) as f:
+                header = f.readline()
+                s = f.read()
+            if header != '%d %s\n' % (Network.ENUMERATION_VERSION, digest) \
+                    or not s.endswith('\n.\n'):
+                return None
+            return GraphSet.loads(s)
+        except Exception:
+            return None
+
+    def _save_elec_feasible_configs(self, digest, gs):
+        path = os.path.join(self._cache_dir, digest + '.gs')
+        data = '%d %s\n%s' % (Network.ENUMERATION_VERSION, digest, gs.dumps())
+        _write_atomically(path, data.encode())
+
+    def _enumerate_trees_in_parallel(self, roots, workers):
+        constants = (Network.MAX_CURRENT, Network.SENDING_VOLTAGE,
+                     Network.VOLTAGE_RANGE, Network.NUM_PHASES)
+        pool = multiprocessing.Pool(min(workers, len(roots)), _init_worker,
+                                    (self._get_state(), constants))
+        try:
+            for root, s in pool.imap_unordered(_enumerate_trees_worker, roots):
+                self._elec_feasible_configs[root] = GraphSet.loads(s)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _sample_stats(self, gs, n, seed, workers, percentiles, bins):
+        if seed is None:
+            seed = random.randrange(1 << 63)
+        zdd = gs.dumps()
+        # samples are drawn in fixed chunks with their own seeds, so the
+        # result does not depend on the number of workers
+        chunks = [(seed, c, min(_SAMPLE_CHUNK, n - c * _SAMPLE_CHUNK),
+                   (n + _MAX_KEPT_SAMPLES - 1) // _MAX_KEPT_SAMPLES)
+                  for c in range((n + _SAMPLE_CHUNK - 1) // _SAMPLE_CHUNK)]
+        if workers is not None and workers > 1 and len(chunks) > 1:
+            constants = (Network.MAX_CURRENT, Network.SENDING_VOLTAGE,
+                         Network.VOLTAGE_RANGE, Network.NUM_PHASES)
+            pool = multiprocessing.Pool(min(workers, len(chunks)), _init_worker,
+                                        (self._get_state(), constants, zdd))
+            try:
+                results = pool.imap(_sample_chunk_worker, chunks)
+                stats = self._merge_sample_stats(results)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            zdd = _parse_zdd(zdd, len(self.switches))
+            stats = self._merge_sample_stats(
+                self._sample_chunk(zdd, *chunk) for chunk in chunks)
+        count, mean, m2, kept = stats
+        kept.sort()
+        histogram = [0] * bins
+        lo, hi = (kept[0], kept[-1]) if kept else (0.0, 0.0)
+        width = (hi - lo) / bins
+        for x in kept:
+            histogram[min(int((x - lo) / width), bins - 1) if width > 0 else 0] += 1
+        return {'n': count, 'seed': seed, 'mean': mean,
+                'variance': m2 / (count - 1) if count > 1 else 0.0,
+                'percentiles': dict((q, _percentile(kept, q)) for q in percentiles),
+                'histogram': (histogram, [lo + width * i for i in range(bins + 1)])}
+
+    def _merge_sample_stats(self, results):
+        # losses are merged by Chan's formula, while only every stride-th
+        # loss is kept for the percentiles and the histogram
+        count, mean, m2, kept = 0, 0.0, 0.0, []
+        for count2, mean2, m22, kept2 in results:
+            if count2 == 0:
+                continue
+            total = count + count2
+            delta = mean2 - mean
+            mean += delta * count2 / total
+            m2 += m22 + delta * delta * count * count2 / total
+            count = total
+            kept.extend(kept2)
+        return count, mean, m2, kept
+
+    def _sample_chunk(self, zdd, seed, c, size, stride):
+        rng = random.Random('%d:%d' % (seed, c))
+        configs = [sum([1 << (v - 1) for v in _sample_zdd(zdd, rng)])
+                   for i in range(size)]
+        losses = self.evaluate_many(configs)[0]
+        count, mean, m2, kept = 0, 0.0, 0.0, []
+        for i, x in enumerate(losses):
+            count += 1
+            delta = x - mean
+            mean += delta / count
+            m2 += delta * (x - mean)
+            if (c * _SAMPLE_CHUNK + i) % stride == 0:
+                kept.append(x)
+        return count, mean, m2, kept
+
     def _has_same_topology(self, other):
         return self.nodes == other.nodes and self.switches == other.switches
 
@@ -192,79 +708,141 @@ class Network(object):
         return [self._to_switch(e) for e in forest]
 
     def _to_forest(self, config):
+        if isinstance(config, int):
+            return [self.graph.edges[i] for i in _bits(config)]
         return [self._to_edge(s) for s in config]
 
+    def _to_mask_from_forest(self, forest):
+        mask = 0
+        for e in forest:
+            mask |= self.graph._edge2bit[e]
+        return mask
+
     def _get_root_sections(self):
-        root_sections = set()
-        for s in self.sections:
-            if self.sections[s]['substation']:
-                root_sections.add(s)
-        return root_sections
+        return set([self._elems[i] for i in self._root_ids])
 
     def _find_neighbors(self, s):
-        if s not in self._neighbor_cache:
-            neighbors = flatten([n for n in self.nodes if s in n])
-            self._neighbor_cache[s] = set(neighbors) - set([s])
-        return self._neighbor_cache[s]
-
-    def _build_tree(self, root, closed_switches, processed_elems):
-        branches = []
-        neighbors = self._find_neighbors(root) - processed_elems
-        if len(neighbors) == 1:
-            s = neighbors.pop()
-            assert s in self._switch_set
-            if s in closed_switches:
-                t = (self._find_neighbors(s) - set([root])).pop()
-                branches.append((root, t))
-                ps = processed_elems | set([root, s, t])
-                bs = self._build_tree(t, closed_switches - set([s]), ps)
-                branches.extend(bs)
-        elif len(neighbors) > 1: # junction
-            for s in neighbors:
-                assert s in self.sections, (root, neighbors, s)
-                branches.append((root, s))
-            for s in neighbors:
-                ps = processed_elems | set([root]) | neighbors
-                bs = self._build_tree(s, closed_switches.copy(), ps)
-                branches.extend(bs)
-        return branches
-
-    def _calc_current(self, root, branches):
-        n_phases = Network.NUM_PHASES
-        current = { root: [0, 0, 0] }
-        for branch in branches:
-            s, t = branch
-            load = self.sections[t]['load']
-            if t not in current:
-                current[t] = [0, 0, 0]
-            current[t] = [current[t][i] + load[i] for i in range(n_phases)]
-            while True:
-                if s not in current:
-                    current[s] = [0, 0, 0]
-                current[s] = [current[s][i] + load[i] for i in range(n_phases)]
-                upper_branch = [b for b in branches if b[1] == s]
-                assert len(upper_branch) <= 1
-                if len(upper_branch) == 1:
-                    s, t = upper_branch[0]
+        i = self._elem_ids[s]
+        return set([self._elems[j] for j in self._adj[self._adj_ptr[i]:self._adj_ptr[i + 1]]])
+
+    def _find_nodes(self, s):
+        i = self._elem_ids[s]
+        return [self.nodes[k] for k in self._elem_nodes[self._elem_ptr[i]:self._elem_ptr[i + 1]]]
+
+    def _build_tree(self, root, closed, barrier=(), marks=None):
+        """Builds the tree fed by the root through the closed switches.
+
+        Sections are traversed from the root with marker arrays of
+        sections and junction groups, which can be shared by trees of
+        the other roots.  Closed switches are given by a bitmask, or by
+        the flags of _flags().  Returns a pair of section IDs ordered from the
+        root and the positions of their parents, or None if the closed
+        switches make a loop.  Sections in the barrier are not entered.
+        """
+        n = self._num_sections
+        link_ptr = self._link_ptr
+        link_sections = self._link_sections
+        link_switches = self._link_switches
+        link_groups = self._link_groups
+        if marks is None:
+            marks = (bytearray(n), bytearray(self._num_groups))
+        in_tree, entered = marks
+        if entered[self._groups[root]]:
+            return None
+        entered[self._groups[root]] = 1
+        in_tree[root] = 1
+        for s in barrier:
+            in_tree[s] = 1
+        if isinstance(closed, int):
+            closed = _flags(closed, len(self.switches))
+        order = [root]
+        parents = [-1]
+        via = [-1]  # switch through which the section is entered
+        k = 0
+        while k < len(order):
+            s = order[k]
+            w0 = via[k]
+            for x in range(link_ptr[s], link_ptr[s + 1]):
+                w = link_switches[x]
+                t = link_sections[x]
+                if w < 0:
+                    if in_tree[t]:
+                        continue
+                elif w == w0 or not closed[w - n] & 1:
+                    continue
+                elif entered[link_groups[x]] or in_tree[t]:
+                    return None
                 else:
-                    break
-        load = self.sections[root]['load']
-        current[root] = [current[root][i] + load[i] for i in range(n_phases)]
+                    entered[link_groups[x]] = 1
+                in_tree[t] = 1
+                order.append(t)
+                parents.append(k)
+                via.append(w)
+            k += 1
+        return order, parents
+
+    def _evaluate(self, closed, cache):
+        nan = float('nan')
+        closed = _flags(closed, len(self.switches))
+        marks = (bytearray(self._num_sections), bytearray(self._num_groups))
+        trees = []
+        for r in self._root_ids:
+            tree = self._build_tree(r, closed, marks=marks)
+            if tree is None:
+                return nan, False, nan, nan
+            trees.append(tree)
+        loss = 0.0
+        feasible = sum([len(order) for order, parents in trees]) == self._num_sections
+        voltage = float('inf')
+        peak = 0.0
+        for order, parents in trees:
+            key = (tuple(order), tuple(parents))
+            if key not in cache:
+                cache[key] = self._evaluate_tree(order, parents)
+            l, f, v, j = cache[key]
+            loss += l
+            feasible = feasible and f
+            voltage = min(voltage, v)
+            peak = max(peak, j)
+        if voltage == float('inf'):
+            voltage = nan
+        return loss, feasible, voltage, peak
+
+    def _evaluate_tree(self, order, parents):
+        # the same sweeps and limits as loss() and enumerate()
+        tree = self._make_tree(order, parents)
+        loss = self._calc_tree_loss(order, tree.current)
+        feasible = self._satisfies_tree_constraints(tree)
+        voltage = min([float('inf')] + list(self._calc_leaf_voltages(tree)))
+        peak = max([abs(j) for j in tree.current[0]])
+        return loss, feasible, voltage, peak
+
+    def _calc_current(self, order, parents):
+        # sections are ordered from the root, so that a single backward
+        # sweep accumulates downstream loads into upper sections
+        n_phases = Network.NUM_PHASES
+        current = [list(self._loads[s]) for s in order]
+        for k in range(len(order) - 1, 0, -1):
+            j = current[parents[k]]
+            c = current[k]
+            for i in range(n_phases):
+                j[i] += c[i]
         return current
 
-    def _calc_loss(self, root, closed_switches, barrier, no_root=False):
-        branches = self._build_tree(root, closed_switches, barrier)
-        assert is_tree(branches), 'loop found'
-        sections = set([root] + flatten(branches))
-        current = self._calc_current(root, branches)
+    def _calc_loss(self, root, closed, barrier=(), no_root=False):
+        tree = self._build_tree(root, closed, barrier)
+        assert tree is not None, 'loop found'
+        order, parents = tree
+        return self._calc_tree_loss(order, self._calc_current(order, parents), no_root)
+
+    def _calc_tree_loss(self, order, current, no_root=False):
         loss = 0.0
-        for s in sections:
-            if no_root and self.sections[s]['substation']:
+        for k, s in enumerate(order):
+            if no_root and self._substations[s]:
                 continue
             for i in range(Network.NUM_PHASES):
-                j = current[s][i]
-                r = self.sections[s]['impedance'][i].real
-                loss += self._do_calc_loss(j, r)
+                r = self._impedances[s][i].real
+                loss += self._do_calc_loss(current[k][i], r)
         return loss
 
     def _do_calc_loss(self, current, resistance):
@@ -299,14 +877,14 @@ class Network(object):
             graph.edges.append(e)
             graph._switch2edge[s] = e
             graph._edge2switch[e] = s
+            graph._edge2bit[e] = 1 << (len(graph.edges) - 1)
         assert len(graph.edges) == len(self.switches)
 
-        for s in self.sections:
-            if self.sections[s]['substation']:
-                for t in self._find_neighbors(s):
-                    if t < s:
-                        s = t
-                graph.roots.add(sorted_sections.index(s) + 1)
+        for s in self._get_root_sections():
+            for t in self._find_neighbors(s):
+                if t < s:
+                    s = t
+            graph.roots.add(sorted_sections.index(s) + 1)
         assert len(graph.roots) == len(self._get_root_sections())
 
         GraphSet.set_universe(graph.edges, traversal='as-is')
@@ -325,131 +903,193 @@ class Network(object):
         return GraphSet.graphs(vertex_groups=vg, degree_constraints=dc,
                                no_loop=True)
 
-    def _find_neighbor_switches(self, s, processed_sections):
-        switches = set()
-        if s in self._switch_set:
-            for t in self._find_neighbors(s) - processed_sections:
-                assert t in self.sections
-                processed_sections.add(t)
-                for u in self._find_neighbor_switches(t, processed_sections.copy()):
-                    switches.add(u)
+    def _find_neighbor_switches(self, s):
+        # switches reachable without crossing other switches, as a bitmask
+        i = self._elem_ids[s]
+        if i < self._num_sections:
+            return self._group_switches[self._groups[i]]
         else:
-            processed_sections.add(s)
-            for t in self._find_neighbors(s) - processed_sections:
-                if t in self._switch_set:
-                    switches.add(t)
-                else:
-                    for u in self._find_neighbor_switches(t, processed_sections.copy()):
-                        switches.add(u)
-        return switches - set([s])
-
-    def _find_surrounding_switches(self, root, closed_switches):
-        if len(closed_switches) > 0:
-            switches = set()
-            for s in closed_switches:
-                for t in self._find_neighbor_switches(s, set()):
-                    switches.add(t)
-            return switches - closed_switches
+            return self._switch_neighbors[i - self._num_sections]
+
+    def _find_surrounding_switches(self, root, closed):
+        if closed:
+            switches = 0
+            for i in _bits(closed):
+                switches |= self._switch_neighbors[i]
+            return switches & ~closed
         else:
-            return self._find_neighbor_switches(root, set())
+            return self._find_neighbor_switches(root)
 
     def _find_border_switches(self, root):
-        assert self.sections[root]['substation']
-        border = set()
+        assert self._substations[self._elem_ids[root]]
+        border = 0
         for r in self._get_root_sections() - set([root]):
-            for s in self._find_neighbor_switches(r, set()):
-                border.add(s)
+            border |= self._find_neighbor_switches(r)
         return border
 
-    def _satisfies_electric_constraints(self, root, closed_switches):
-        branches = self._build_tree(root, closed_switches, set())
-        if not is_tree(branches):
-            return False
-
-        current = self._calc_current(root, branches)
-        for i in range(Network.NUM_PHASES):
-            if abs(current[root][i]) > Network.MAX_CURRENT:
+    def _satisfies_tree_constraints(self, tree):
+        for j in tree.current[0]:
+            if abs(j) > Network.MAX_CURRENT:
                 return False
-        assert len(current) == len(set(flatten(branches)))
 
-        leaves = set(flatten(branches)) - set([b[0] for b in branches])
-        for s in leaves:
-            voltage_drop = []
-            for i in range(Network.NUM_PHASES):
-                j = current[s][i]
-                z = self.sections[s]['impedance'][i]
-                voltage_drop.append(j * z / 2)
-            bs = [b for b in branches if b[1] == s]
-            assert len(bs) == 1
-            s, t = bs[0]
-            while True:
-                for i in range(Network.NUM_PHASES):
-                    j = current[s][i]
-                    z = self.sections[s]['impedance'][i]
-                    voltage_drop[i] += j * z
-                upper_branch = [b for b in branches if b[1] == s]
-                assert len(upper_branch) <= 1
-                if len(upper_branch) == 1:
-                    s, t = upper_branch[0]
-                else:
-                    break
-            v = voltage_drop
-            v0 = Network.SENDING_VOLTAGE
-            vl, vh = Network.VOLTAGE_RANGE
-            for i in range(Network.NUM_PHASES):
-                if abs(v0 - v[i]) < vl or vh < abs(v0 - v[i]):
-                    return False
+        vl, vh = Network.VOLTAGE_RANGE
+        for u in self._calc_leaf_voltages(tree):
+            if u < vl or vh < u:
+                return False
 
         return True
 
-    def _find_trees(self, closed_switches, open_switches):
-        closed_switches = [self._to_edge(s) for s in closed_switches]
-        open_switches = [self._to_edge(s) for s in open_switches]
-        return GraphSet({'include': closed_switches, 'exclude': open_switches})
-
-    def _do_enumerate_trees(self, root, closed_switches, fixed_switches):
-        gs = GraphSet()
-        sur_switches = self._find_surrounding_switches(root, closed_switches)
-        unfixed_switches = sur_switches - fixed_switches
-        if len(unfixed_switches) == 0:
-            return gs
-        s = sorted(unfixed_switches)[0]
-        fixed_switches.add(s)
-        gs |= self._do_enumerate_trees(root, closed_switches.copy(), fixed_switches.copy())
-        closed_switches.add(s)
-        if self._satisfies_electric_constraints(root, closed_switches):
-            sur_switches = self._find_surrounding_switches(root, closed_switches)
-            gs |= self._find_trees(closed_switches, sur_switches)
-            gs |= self._do_enumerate_trees(root, closed_switches.copy(), fixed_switches.copy())
-        return gs
+    def _calc_leaf_voltages(self, tree):
+        # a single forward sweep accumulates voltage drops from the root;
+        # the voltage is yielded at the middle of each leaf section
+        n_phases = Network.NUM_PHASES
+        v0 = Network.SENDING_VOLTAGE
+        j = tree.current[0]
+        z = self._impedances[tree.root]
+        voltage_drop = [[j[i] * z[i] for i in range(n_phases)]]
+        for k in range(1, len(tree.order)):
+            v = voltage_drop[tree.parents[k]]
+            j = tree.current[k]
+            z = self._impedances[tree.order[k]]
+            if tree.num_children[k] > 0:
+                voltage_drop.append([v[i] + j[i] * z[i] for i in range(n_phases)])
+            else:
+                voltage_drop.append(None)
+                for i in range(n_phases):
+                    yield abs(v0 - (v[i] + j[i] * z[i] / 2))
+
+    def _make_tree(self, order, parents):
+        tree = Tree(order[0])
+        tree.current = self._calc_current(order, parents)
+        self._add_branches(tree, order[1:], parents[1:])
+        return tree
+
+    def _add_branches(self, tree, order, parents):
+        # parents are positions in the tree
+        for t, p in zip(order, parents):
+            tree.positions[t] = len(tree.order)
+            tree.order.append(t)
+            tree.parents.append(p)
+            tree.num_children.append(0)
+            tree.num_children[p] += 1
+
+    def _grow_tree(self, tree, switch, closed):
+        """Extends the tree by closing the switch.
+
+        Only the new subtree beyond the switch is built, and its current
+        is added to the sections on the path to the root.  Returns the
+        record to undo the change, or None if the switch makes a loop.
+        """
+        w = self._elem_ids[switch]
+        a, b = self._adj[self._adj_ptr[w]:self._adj_ptr[w + 1]]
+        if a not in tree.positions:
+            a, b = b, a
+        if a not in tree.positions or b in tree.positions:
+            return None
+        subtree = self._build_tree(b, closed & ~(1 << (w - self._num_sections)), (a,))
+        if subtree is None:
+            return None
+        order, parents = subtree
+        for t in order:
+            if t in tree.positions:
+                return None
+
+        current = self._calc_current(order, parents)
+        delta = current[0]
+        path = []
+        k = tree.positions[a]
+        while True:
+            j = tree.current[k]
+            path.append((k, j))
+            tree.current[k] = [j[i] + delta[i] for i in range(len(j))]
+            if k == 0:
+                break
+            k = tree.parents[k]
+        n = len(tree.order)
+        undo = (n, tree.positions[a], path)
+        tree.current.extend(current)
+        self._add_branches(tree, order, [tree.positions[a]] + [n + p for p in parents[1:]])
+        return undo
+
+    def _shrink_tree(self, tree, undo):
+        n, k, path = undo
+        for t in tree.order[n:]:
+            del tree.positions[t]
+        del tree.order[n:]
+        del tree.parents[n:]
+        del tree.num_children[n:]
+        del tree.current[n:]
+        tree.num_children[k] -= 1
+        for k, j in path:
+            tree.current[k] = j
+
+    def _find_trees(self, closed, open):
+        return GraphSet({'include': self._to_forest(closed),
+                         'exclude': self._to_forest(open)})
+
+    def _find_all_trees(self, patterns, lo=0, hi=None):
+        # balanced divide-and-conquer union keeps intermediate sets small
+        if hi is None:
+            hi = len(patterns)
+        if hi - lo == 0:
+            return GraphSet()
+        elif hi - lo == 1:
+            return self._find_trees(*patterns[lo])
+        mid = (lo + hi) // 2
+        return self._find_all_trees(patterns, lo, mid) | \
+            self._find_all_trees(patterns, mid, hi)
+
+    def _do_enumerate_trees(self, tree, closed, fixed, patterns):
+        # closed and fixed switches are given by bitmasks
+        root = self._elems[tree.root]
+        unfixed = self._find_surrounding_switches(root, closed) & ~fixed
+        if not unfixed:
+            return
+        s = min(self.from_mask(unfixed))
+        bit = 1 << (self._elem_ids[s] - self._num_sections)
+        fixed |= bit
+        self._do_enumerate_trees(tree, closed, fixed, patterns)
+        closed |= bit
+        undo = self._grow_tree(tree, s, closed)
+        if undo is not None:
+            if self._satisfies_tree_constraints(tree):
+                sur_switches = self._find_surrounding_switches(root, closed)
+                patterns.append((closed, sur_switches))
+                self._do_enumerate_trees(tree, closed, fixed, patterns)
+            self._shrink_tree(tree, undo)
 
     def _enumerate_trees(self, root):
-        gs = GraphSet()
-        if self._satisfies_electric_constraints(root, set()):
-            sur_switches = self._find_surrounding_switches(root, set())
-            gs = self._find_trees(set(), sur_switches)
+        tree = self._build_tree(self._elem_ids[root], 0)
+        if tree is None:
+            return GraphSet()  # no switch can remove the loop
+        tree = self._make_tree(*tree)
+        patterns = []  # pairs of closed and open switches
+        if self._satisfies_tree_constraints(tree):
+            sur_switches = self._find_surrounding_switches(root, 0)
+            patterns.append((0, sur_switches))
         border_switches = self._find_border_switches(root)
-        return gs | self._do_enumerate_trees(root, set(), border_switches)
+        self._do_enumerate_trees(tree, 0, border_switches, patterns)
+        return self._find_all_trees(patterns)
 
     def _find_components(self):
         switches = set(self.switches)
         sections = set(self.sections.keys())
         roots = self._get_root_sections()
-        uf = UnionFind()
-        uf.insert_objects(switches | sections - roots)
-        for s in sorted(switches | sections - roots):
-            neighbors = set()
-            for n in [m for m in self.nodes if s in m]:
-                if [t for t in n if t in roots] == []:
-                    for t in n:
-                        neighbors.add(t)
-            for t in sorted(neighbors - set([s])):
-                uf.union(s, t)
+        # elements are joined by the nodes without root sections
+        uf = UnionFind(range(len(self._elems)))
+        elems1, elems2 = [], []
+        for k in range(len(self.nodes)):
+            elems = self._node_elems[self._node_ptr[k]:self._node_ptr[k + 1]]
+            if not [i for i in elems if i < self._num_sections and self._substations[i]]:
+                elems1.extend([elems[0]] * (len(elems) - 1))
+                elems2.extend(elems[1:])
+        uf.union_pairs(elems1, elems2)
+        labels = uf.labels()
 
         i = 1
         comps = {}
         for s in self.switches:
-            c = uf.find(s)
+            c = labels[self._elem_ids[s]]
             if c not in comps:
                 comps[c] = (i, set())
                 i += 1
@@ -476,24 +1116,31 @@ class Network(object):
 
         return comps
 
-    def _find_configs(self, n, comp, closed_switches):
-        n = self._zdd[n]
-        configs = []
-        if n.v > len(self.switches) or self.switches[n.v - 1] not in comp:
-            configs.append((closed_switches, n.n))
+    def _find_configs(self, n, comp, offset, tables):
+        # comp is the bitmask of switches in the component shifted by
+        # offset, and tables memoizes closed switches in the same shifted
+        # bitmasks and exit nodes for each node in the component
+        if n in tables:
+            return tables[n]
+        zdd = self._zdd
+        v = zdd.var[n] - 1 - offset
+        if v < 0 or not comp >> v & 1:
+            table = ([0], [n])
         else:
-            if n.l != 'B':
-                configs2 = self._find_configs(n.l, comp, closed_switches.copy())
-                configs.extend(configs2)
-            assert n.h != 'B'
-            closed_switches.add(self.switches[n.v - 1])
-            configs.extend(self._find_configs(n.h, comp, closed_switches.copy()))
-        return configs
-
-    def _calc_component_loss(self, comp_roots, closed_switches):
+            masks, exits = [], []
+            if zdd.lo[n] != 0:
+                masks, exits = self._find_configs(zdd.lo[n], comp, offset, tables)
+            assert zdd.hi[n] != 0
+            hi_masks, hi_exits = self._find_configs(zdd.hi[n], comp, offset, tables)
+            bit = 1 << v
+            table = (masks + [closed | bit for closed in hi_masks], exits + hi_exits)
+        tables[n] = table
+        return table
+
+    def _calc_component_loss(self, comp_roots, closed):
         loss = 0
         for root, barrier in comp_roots:
-            loss += self._calc_loss(root, closed_switches, barrier)
+            loss += self._calc_loss(root, closed, barrier)
         return loss
 
     def _rebuild(self, entries, comp):
@@ -501,33 +1148,75 @@ class Network(object):
         for s in comp:
             if s in self.sections:
                 for t in self._find_neighbors(s):
-                    if t in self.sections and self.sections[t]['substation']:
-                        assert not self.sections[s]['substation']
+                    if t in self.sections and self._substations[self._elem_ids[t]]:
+                        assert not self._substations[self._elem_ids[s]]
                         barrier = set()
                         for u in self._find_neighbors(s):
                             if u in self.sections:
                                 barrier.add(u)
-                        comp_roots.append((s, barrier))
+                        comp_roots.append((self._elem_ids[s],
+                                           [self._elem_ids[u] for u in barrier]))
                         break
 
+        comp_switches = self.to_mask([s for s in comp if s in self._switch_set])
+        offset = max((comp_switches & -comp_switches).bit_length() - 1, 0)
+        comp_switches >>= offset
+        rows = []
         next_entries = set()
-        loss_cache = {}
+        tables = {}
         for n in entries:
-            for closed_switches, m in self._find_configs(n, comp, set()):
-                next_entries.add(m)
-                key = ','.join([str(s) for s in sorted(closed_switches)])
-                if key in loss_cache:
-                    loss = loss_cache[key]
+            masks, exits = self._find_configs(n, comp_switches, offset, tables)
+            rows.append((n, masks, exits))
+            next_entries.update(exits)
+
+        return comp_roots, offset, rows, next_entries
+
+    def _calc_layer_losses(self, layers, workers):
+        # unique configurations in each component are looked up in the
+        # cache keyed by the component index, and the rest are evaluated
+        # in chunks
+        losses = [{} for layer in layers]
+        owners, tasks = [], []
+        for i, (comp_roots, offset, rows, _) in enumerate(layers):
+            closed_set = {}
+            for n, masks, exits in rows:
+                closed_set.update(dict.fromkeys(masks))
+            closed_list = []
+            for closed in closed_set:
+                key = (i, closed)
+                if key in self._loss_cache:
+                    self._loss_cache.move_to_end(key)
+                    losses[i][closed] = self._loss_cache[key]
+                    self._loss_cache_hits += 1
                 else:
-                    loss = self._calc_component_loss(comp_roots, closed_switches)
-                    loss_cache[key] = loss
-                if not(n in self.search_space.graph \
-                           and m in self.search_space.graph[n] \
-                           and loss > self.search_space.graph[n][m]['weight']):
-                    self.search_space.graph.add_edge(n, m, weight=loss,
-                                                     config=closed_switches)
-
-        return next_entries
+                    closed_list.append(closed)
+                    self._loss_cache_misses += 1
+            for j in range(0, len(closed_list), _LOSS_CHUNK):
+                owners.append(i)
+                tasks.append((comp_roots, offset, closed_list[j:j + _LOSS_CHUNK]))
+        if workers is not None and workers > 1 and len(tasks) > 1:
+            constants = (Network.MAX_CURRENT, Network.SENDING_VOLTAGE,
+                         Network.VOLTAGE_RANGE, Network.NUM_PHASES)
+            pool = multiprocessing.Pool(min(workers, len(tasks)), _init_worker,
+                                        (self._get_state(), constants))
+            try:
+                results = list(pool.imap(_component_losses_worker, tasks))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._calc_component_losses(*task) for task in tasks]
+        for i, task, result in zip(owners, tasks, results):
+            for closed, loss in zip(task[2], result):
+                losses[i][closed] = loss
+                self._loss_cache[(i, closed)] = loss
+        while len(self._loss_cache) > Network.LOSS_CACHE_SIZE:
+            self._loss_cache.popitem(last=False)
+        return losses
+
+    def _calc_component_losses(self, comp_roots, offset, closed_list):
+        return [self._calc_component_loss(comp_roots, closed << offset)
+                for closed in closed_list]
 
     def _cut_from_hit(self, hitting_set):
         hitting_edge_set = [self._to_edge(sw) for sw in hitting_set]
@@ -538,3 +1227,118 @@ class Network(object):
     SENDING_VOLTAGE = 6600 / sqrt(3)
     VOLTAGE_RANGE   = (6300 / sqrt(3), 6900 / sqrt(3))
     NUM_PHASES = 3
+    LOSS_CACHE_SIZE = 100000
+
+    COMPILED_VERSION = 6
+    # bump this when a change in the enumeration alters its results
+    ENUMERATION_VERSION = 1
+    _COMPILED_ATTRS = ('nodes', 'switches', '_switch_set', '_elems', '_elem_ids',
+                       '_num_sections', '_loads', '_impedances', '_substations',
+                       '_root_ids', '_node_ptr', '_node_elems',
+                       '_elem_ptr', '_elem_nodes', '_adj_ptr', '_adj',
+                       '_groups', '_num_groups', '_link_ptr', '_link_sections',
+                       '_link_switches', '_link_groups', '_group_switches',
+                       '_switch_neighbors', 'graph')
+
+
+def _write_atomically(path, data):
+    dir = os.path.dirname(path)
+    os.makedirs(dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _bits(mask):
+    # indices of the set bits from the lowest
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def _flags(mask, n):
+    # bytes of which the i-th item is odd if the i-th bit is set
+    return bin(mask)[:1:-1].ljust(n, '0').encode()
+
+
+def _split_lines(s, size=1 << 20):
+    # lines are split in chunks of about the size, not to copy the whole
+    # string at once
+    start = 0
+    while start < len(s):
+        end = s.find('\n', start + size)
+        if end < 0:
+            end = len(s)
+        for line in s[start:end].split('\n'):
+            yield line
+        start = end + 1
+
+
+def _parse_zdd(s, num_vars):
+    # a ZDD with the number of paths for sampling
+    zdd = ZDD(s, num_vars)
+    return zdd, zdd.count_paths()
+
+
+def _sample_zdd(zdd, rng):
+    # descends from the root choosing a child in proportion to its paths,
+    # which draws a set uniformly at random
+    zdd, count = zdd
+    n = zdd.root
+    if count[n] == 0:
+        raise ValueError('sample from an empty set')
+    sample = []
+    while n > 1:
+        if rng.randrange(count[n]) < count[zdd.hi[n]]:
+            sample.append(zdd.var[n])
+            n = zdd.hi[n]
+        else:
+            n = zdd.lo[n]
+    return sample
+
+
+def _percentile(sorted_values, q):
+    # linear interpolation between the nearest ranks
+    if not sorted_values:
+        return float('nan')
+    x = (len(sorted_values) - 1) * q / 100.0
+    i = int(x)
+    if i + 1 >= len(sorted_values):
+        return sorted_values[-1]
+    return sorted_values[i] + (sorted_values[i + 1] - sorted_values[i]) * (x - i)
+
+
+_SAMPLE_CHUNK = 1000
+_LOSS_CHUNK = 100
+_MAX_KEPT_SAMPLES = 100000
+
+_worker_network = None
+_worker_zdd = None
+
+
+def _init_worker(state, constants, zdd=None):
+    global _worker_network, _worker_zdd
+    Network.MAX_CURRENT, Network.SENDING_VOLTAGE, Network.VOLTAGE_RANGE, \
+        Network.NUM_PHASES = constants
+    _worker_network = Network.__new__(Network)
+    _worker_network._set_state(state)
+    if zdd is not None:
+        _worker_zdd = _parse_zdd(zdd, len(_worker_network.switches))
+
+
+def _enumerate_trees_worker(root):
+    return root, _worker_network._enumerate_trees(root).dumps()
+
+
+def _sample_chunk_worker(chunk):
+    return _worker_network._sample_chunk(_worker_zdd, *chunk)
+
+
+def _component_losses_worker(task):
+    return _worker_network._calc_component_losses(*task)
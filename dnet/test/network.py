@@ -17,8 +17,14 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from dnet import Network, ConfigSet
+from dnet import Network, ConfigSet, FukuiTepcoConverter
+from dnet.unionfind import UnionFind
+from dnet.util import flatten, is_tree
+import os
+import shutil
+import tempfile
 import unittest
+import yaml
 
 class TestNetwork(unittest.TestCase):
 
@@ -41,6 +47,9 @@ class TestNetwork(unittest.TestCase):
         self.assertEqual(len(nw.sections['section_1068']['impedance']), 3)
         self.assertAlmostEqual(nw.sections['section_1068']['impedance'][0], 0.1539000+0.4512584j, 3)
         self.assertFalse(nw.sections['section_1068']['substation'])
+        self.assertTrue(nw.sections['section_-001']['substation'])
+        self.assertFalse('switch_0001' in nw.sections)
+        self.assertRaises(KeyError, lambda: nw.sections['switch_0001'])
 
         self.assertTrue(nw.graph)
         self.assertEqual(nw.graph.edges, [(1, 2), (3, 2), (2, 4), (5, 3),
@@ -54,6 +63,18 @@ class TestNetwork(unittest.TestCase):
         self.assertEqual(len(nw.graph._edge2switch), 16)
         self.assertEqual(nw.graph._edge2switch[(1, 2)], 'switch_0001')
 
+        self.assertEqual(nw._find_neighbors('section_0302'),
+                         set(['section_-001', 'section_0303', 'switch_0010']))
+        self.assertEqual(nw._find_neighbors('switch_0010'),
+                         set(['section_0302', 'section_0300']))
+        self.assertEqual(nw._find_nodes('switch_0010'),
+                         [['section_0302', 'switch_0010'],
+                          ['section_0300', 'switch_0010']])
+        self.assertEqual(nw.from_mask(nw._find_neighbor_switches('switch_0010')),
+                         ['switch_0006', 'switch_0009', 'switch_0014'])
+        self.assertEqual(nw.from_mask(nw._find_border_switches('section_-001')),
+                         ['switch_0001', 'switch_0011', 'switch_0013', 'switch_0016'])
+
         configs = nw.enumerate()
         self.assertTrue(isinstance(configs, ConfigSet))
         self.assertEqual(len(configs), 111)
@@ -90,6 +111,7 @@ class TestNetwork(unittest.TestCase):
                          set(['switch_0004', 'switch_0007', 'switch_0012',
                               'switch_0015']))
 
+        self.assertEqual(nw._zdd.count_paths()[nw._zdd.root], 111)
         self.assertEqual(len(nw.search_space.graph.edges()), 10)
         #self.assertAlmostEqual(nw.search_space.graph['38']['T']['weight'], 236.191, 3)
         #self.assertEqual(nw.search_space.start, '4114')
@@ -127,6 +149,307 @@ class TestNetwork(unittest.TestCase):
         self.assertAlmostEqual(loss, 72055.7, 0)
         self.assertAlmostEqual(lower_bound, 69238.4, 0)
 
+    def test_parallel_enumeration(self):
+        nw = Network('data/test.yaml')
+        configs = nw.enumerate(workers=2)
+        self.assertEqual(len(configs), 111)
+        self.assertEqual(len(nw._elec_feasible_configs), 3)
+
+        nw2 = Network('data/test.yaml')
+        self.assertTrue(nw2.enumerate() == configs)
+
+    def test_parallel_optimization(self):
+        nw = Network('data/test.yaml')
+        configs = nw.enumerate()
+        optimal_config = nw.optimize(configs, workers=2)
+        graph = nw.search_space.graph
+
+        self.assertEqual(nw.optimize(configs), optimal_config)
+        self.assertEqual(len(nw.search_space.graph.edges()), len(graph.edges()))
+        for u, v in graph.edges():
+            self.assertEqual(nw.search_space.graph[u][v], graph[u][v])
+
+    def test_loss_cache(self):
+        nw = Network('data/test.yaml')
+        configs = nw.enumerate()
+        optimal_config = nw.optimize(configs)
+        info = nw.loss_cache_info()
+        self.assertEqual(info['hits'], 0)
+        self.assertTrue(info['misses'] > 0)
+        self.assertEqual(info['size'], info['misses'])
+
+        subset = configs.including('switch_0001')
+        self.assertEqual(nw.optimize(configs), optimal_config)
+        nw.optimize(subset)
+        self.assertEqual(nw.loss_cache_info()['misses'], info['misses'])
+        self.assertTrue(nw.loss_cache_info()['hits'] > info['misses'])
+
+        nw.update_loads({'section_0001': [32.0, 5.7, 30.7, 5.6, 31.4, 5.7]})
+        self.assertEqual(nw.loss_cache_info()['size'], 0)
+        nw2 = Network('data/test.yaml')
+        nw2.update_loads({'section_0001': [32.0, 5.7, 30.7, 5.6, 31.4, 5.7]})
+        self.assertEqual(nw.optimize(subset), nw2.optimize(subset))
+
+    def test_bitmask(self):
+        nw = Network('data/test.yaml')
+        configs = nw.enumerate()
+        config = ['switch_0001', 'switch_0003', 'switch_0016']
+        self.assertEqual(nw.to_mask(config), 0b1000000000000101)
+        self.assertEqual(nw.from_mask(0b1000000000000101), config)
+
+        masks = list(configs.mask_iter())
+        self.assertEqual(len(masks), 111)
+        self.assertEqual([nw.from_mask(m) for m in masks], [sorted(c) for c in configs])
+        self.assertTrue(masks[0] in configs)
+        self.assertEqual(nw.loss(masks[0]), nw.loss(nw.from_mask(masks[0])))
+
+        configs.remove(nw.from_mask(masks[0]))
+        self.assertFalse(masks[0] in configs)
+        configs.remove(masks[1])
+        self.assertFalse(nw.from_mask(masks[1]) in configs)
+        configs.discard(masks[1])
+        configs.discard(nw.from_mask(masks[2]))
+        self.assertEqual(len(configs), 108)
+        self.assertRaises(KeyError, configs.remove, masks[2])
+        self.assertEqual(nw.evaluate_many(masks[:5]),
+                         nw.evaluate_many([nw.from_mask(m) for m in masks[:5]]))
+        self.assertEqual(len(configs.including(nw.to_mask(['switch_0002']))),
+                         len(configs.including('switch_0002')))
+
+    def test_deep_feeder(self):
+        # a feeder much deeper than the recursion limit
+        depth = 3000
+        z = [0.001, 0.001] * 3
+        obj = {'nodes': [['section_-001', 'section_0000', 'section_0001']],
+               'switches': [],
+               'sections': {'section_-001': {'load': [0] * 6, 'impedance': z,
+                                             'substation': True}}}
+        for i in range(depth + 2):
+            obj['sections']['section_%04d' % i] = \
+                {'load': [0.01, 0] * 3, 'impedance': z, 'substation': False}
+        for i in range(1, depth + 1):
+            sw = 'switch_%04d' % i
+            obj['switches'].append(sw)
+            obj['nodes'].append(['section_%04d' % i, sw])
+            obj['nodes'].append(['section_%04d' % (i + 1), sw])
+        nw = Network(obj)
+        loss = nw.loss(obj['switches'])
+        self.assertTrue(loss > 0)
+        self.assertAlmostEqual(nw.evaluate_many([obj['switches']])[0][0], loss)
+
+    def test_evaluate_many(self):
+        nw = Network('data/test.yaml')
+        configs = nw.enumerate()
+        samples = list(configs.including('switch_0002').excluding('switch_0003'))
+        losses, feasibility, voltages, currents = nw.evaluate_many(samples)
+        self.assertEqual(len(losses), 15)
+        for config, loss in zip(samples, losses):
+            self.assertAlmostEqual(loss, nw.loss(config), 6)
+        self.assertEqual(feasibility, [True] * 15)
+        for v in voltages:
+            self.assertTrue(Network.VOLTAGE_RANGE[0] <= v <= Network.VOLTAGE_RANGE[1])
+        for j in currents:
+            self.assertTrue(0 < j <= Network.MAX_CURRENT)
+
+        open_switches = ['switch_0004', 'switch_0007', 'switch_0012', 'switch_0015']
+        radial = [s for s in nw.switches if s not in open_switches]
+        unfed = radial[1:]
+        losses, feasibility, voltages, currents = \
+            nw.evaluate_many([radial, unfed, nw.switches])
+        self.assertAlmostEqual(losses[0], 72055.7, 0)
+        self.assertEqual(feasibility, [True, False, False])
+        self.assertTrue(losses[2] != losses[2])  # nan for a loop
+
+        # a modified load model applies to evaluate_many() as well
+        calc_current = nw._calc_current
+        nw._calc_current = lambda order, parents: \
+            [[2 * j for j in c] for c in calc_current(order, parents)]
+        losses, feasibility, voltages, currents = nw.evaluate_many([radial])
+        self.assertAlmostEqual(losses[0], nw.loss(radial), 6)
+        self.assertAlmostEqual(losses[0], 4 * 72055.7, -1)
+
+    def test_sample_stats(self):
+        nw = Network('data/test.yaml')
+        configs = nw.enumerate()
+        losses = nw.evaluate_many(configs)[0]
+        mean = sum(losses) / len(losses)
+
+        stats = configs.sample_stats(2500, seed=1)
+        self.assertEqual(stats['n'], 2500)
+        self.assertEqual(stats['seed'], 1)
+        self.assertTrue(abs(stats['mean'] - mean) < 0.02 * mean)
+        self.assertTrue(stats['variance'] > 0)
+        p = stats['percentiles']
+        self.assertTrue(min(losses) <= p[5] <= p[50] <= p[95] <= max(losses))
+        counts, edges = stats['histogram']
+        self.assertEqual(sum(counts), 2500)
+        self.assertEqual(len(edges), 11)
+
+        self.assertEqual(configs.sample_stats(2500, seed=1, workers=2), stats)
+        self.assertNotEqual(configs.sample_stats(2500, seed=2), stats)
+
+    def test_update_loads(self):
+        nw = Network('data/test.yaml')
+        configs = nw.enumerate()
+        self.assertEqual(len(configs), 111)
+        nw.optimize(configs)
+
+        load = [32.0, 5.706346643, 10.0, 1.0, 3.0, 0.0]
+        nw.update_loads({'section_0001': load})
+        self.assertAlmostEqual(nw.sections['section_0001']['load'][0], 32.0+5.706346643j)
+        self.assertEqual(sorted(nw._elec_feasible_configs.keys()),
+                         ['section_-001', 'section_-003'])
+        self.assertEqual(len(nw.search_space.graph.edges()), 0)
+
+        obj = yaml.safe_load(open('data/test.yaml'))
+        obj['sections']['section_0001']['load'] = load
+        self.assertTrue(nw.enumerate() == Network(obj).enumerate())
+
+        nw.update_impedances({'section_0302': [0.2, 0.5, 0.2, 0.5, 0.2, 0.5]})
+        self.assertEqual(sorted(nw._elec_feasible_configs.keys()),
+                         ['section_-002', 'section_-003'])
+        self.assertRaises(KeyError, nw.update_loads, {'switch_0001': load})
+
+    def test_util(self):
+        self.assertEqual(flatten([1, (2, [3, set([4])]), [], [[5]]]), [1, 2, 3, 4, 5])
+        self.assertEqual(len(flatten([[i] for i in range(100000)])), 100000)
+        self.assertTrue(is_tree([]))
+        self.assertTrue(is_tree([(1, 2), (2, 3), (5, 4)]))
+        self.assertTrue(is_tree([(1, 2), (2, 1)]))  # duplicated branches are merged
+        self.assertFalse(is_tree([(1, 2), (2, 3), (3, 1)]))
+        self.assertFalse(is_tree([(1, 1)]))
+        branches = [(i, i + 1) for i in range(100000)]
+        self.assertTrue(is_tree(branches))
+        self.assertFalse(is_tree(branches + [(100000, 0)]))
+
+    def test_unionfind(self):
+        uf = UnionFind('abcdef')
+        uf.union('a', 'b')
+        uf.union_pairs('ce', 'dc')
+        self.assertEqual(len(uf), 6)
+        self.assertEqual(uf.find('a'), uf.find('b'))
+        self.assertEqual(uf.find('d'), uf.find('e'))
+        self.assertNotEqual(uf.find('a'), uf.find('c'))
+        self.assertEqual(list(uf.labels()), [0, 0, 1, 1, 1, 2])
+        self.assertEqual(uf.find('g'), 'g')  # unknown objects become sets
+        self.assertEqual(list(uf.labels()), [0, 0, 1, 1, 1, 2, 3])
+
+        n = 100000
+        uf = UnionFind(range(n))
+        uf.union_pairs(range(n - 1), range(1, n))
+        self.assertEqual(set(uf.labels()), set([0]))
+
+    def test_fukui_tepco_converter(self):
+        converter = FukuiTepcoConverter('data/test-fukui-tepco')
+        obj = converter.to_dict()
+        self.assertEqual(obj, yaml.safe_load(converter.convert()))
+        self.assertEqual(len(obj['nodes']), 37)
+        self.assertEqual(len(obj['switches']), 16)
+        self.assertEqual(len(obj['sections']), 25)
+        self.assertTrue(obj['sections']['section_-001']['substation'])
+
+    def test_fukui_tepco_snapshots(self):
+        converter = FukuiTepcoConverter('data/test-fukui-tepco')
+        snapshot_dir = tempfile.mkdtemp()
+        try:
+            lines = open('data/test-fukui-tepco/LNewSL.dat').read().splitlines()
+            for k in range(3):
+                with open(os.path.join(snapshot_dir, 'LNewSL-%d.dat' % k), 'w') as f:
+                    for line in lines:
+                        fields = line.split()
+                        fields[4:] = [str(float(x) * (k + 1)) for x in fields[4:]]
+                        f.write('\t'.join(fields) + '\n')
+
+            sections, loads = converter.read_loads(snapshot_dir)
+            self.assertEqual(len(sections), 22)
+            self.assertEqual(len(loads), 3)
+            self.assertEqual(len(loads[0]), 22)
+            self.assertEqual(len(loads[0][0]), 3)
+            i = sections.index('section_1068')
+            self.assertAlmostEqual(loads[0][i][0], 23.87780659+4.33926456j, 3)
+            self.assertAlmostEqual(loads[2][i][0], 3*(23.87780659+4.33926456j), 3)
+
+            objs = list(converter.snapshots(snapshot_dir))
+            self.assertEqual(len(objs), 3)
+            self.assertEqual(objs[0], converter.to_dict())
+            self.assertTrue(objs[1]['nodes'] is objs[0]['nodes'])
+
+            nw = Network(objs[1])
+            self.assertAlmostEqual(nw.sections['section_1068']['load'][0],
+                                   2*(23.87780659+4.33926456j), 3)
+            self.assertEqual(objs[1]['sections']['section_1068']['load'][0],
+                             2*23.87780659)
+        finally:
+            shutil.rmtree(snapshot_dir)
+
+    def test_compiled_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            nw1 = Network('data/test.yaml', cache_dir=cache_dir)
+            self.assertEqual(len([f for f in os.listdir(cache_dir)
+                                  if f.endswith('.dnetc')]), 1)
+
+            nw2 = Network('data/test.yaml', cache_dir=cache_dir)
+            self.assertEqual(nw2.nodes, nw1.nodes)
+            self.assertEqual(nw2.switches, nw1.switches)
+            self.assertEqual(nw2.sections, nw1.sections)
+            self.assertEqual(nw2.graph.edges, nw1.graph.edges)
+            self.assertEqual(nw2.graph.roots, nw1.graph.roots)
+            self.assertEqual(len(nw2.enumerate()), 111)
+
+            nw3 = Network('data/test-fukui-tepco', format='fukui-tepco',
+                          cache_dir=cache_dir)
+            self.assertEqual(len([f for f in os.listdir(cache_dir)
+                                  if f.endswith('.dnetc')]), 2)
+            self.assertEqual(len(nw3.enumerate()), 111)
+
+            # a file pickled with classes unknown to this version is compiled again
+            for f in os.listdir(cache_dir):
+                if f.endswith('.dnetc'):
+                    with open(os.path.join(cache_dir, f), 'wb') as f:
+                        f.write(b'cdnet.network\nNoSuchClass\n.')
+            nw4 = Network('data/test.yaml', cache_dir=cache_dir)
+            self.assertEqual(len(nw4.enumerate()), 111)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_feasible_configs_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            def num_files():
+                return len([f for f in os.listdir(cache_dir) if f.endswith('.gs')])
+
+            nw = Network('data/test.yaml', cache_dir=cache_dir)
+            configs = nw.enumerate()
+            self.assertEqual(num_files(), 3)
+
+            nw = Network('data/test.yaml', cache_dir=cache_dir)
+            nw._enumerate_trees = None  # must not be called
+            self.assertTrue(nw.enumerate() == configs)
+
+            # the load change affects just the root connected to the section
+            file = os.path.join(cache_dir, 'test.yaml')
+            with open(file, 'w') as f:
+                f.write(open('data/test.yaml').read().replace(
+                    'load: [31.40049186, 5.706346643,', 'load: [32.0, 5.706346643,'))
+            nw = Network(file, cache_dir=cache_dir)
+            self.assertTrue(nw.enumerate() == Network(file).enumerate())
+            self.assertEqual(num_files(), 4)
+
+            # broken files are ignored and rewritten
+            files = sorted(f for f in os.listdir(cache_dir) if f.endswith('.gs'))
+            for f, data in zip(files, ['', 'garbage', '1 0123\nB\n.\n']):
+                with open(os.path.join(cache_dir, f), 'w') as f:
+                    f.write(data)
+            expected = Network(file).enumerate()
+            nw = Network(file, cache_dir=cache_dir)
+            self.assertTrue(nw.enumerate() == expected)
+            nw = Network(file, cache_dir=cache_dir)
+            nw._enumerate_trees = None
+            self.assertTrue(nw.enumerate() == expected)
+        finally:
+            shutil.rmtree(cache_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
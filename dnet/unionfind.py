@@ -53,6 +53,9 @@ Spanning Tree algorithm for graphs, but other uses have been found.
 August 12, 2003 Josiah Carlson
 '''
 
+from array import array
+
+
 def Ackerman(inp, memo={0:1}):
 	inp = max(int(inp), 0)
 	if inp in memo:
@@ -76,72 +79,104 @@ def inverseAckerman(inp):
 
 
 
-class UnionFind:
-    def __init__(self):
-        '''\
-Create an empty union find data structure.'''
-        self.num_weights = {}
-        self.parent_pointers = {}
-        self.num_to_objects = {}
-        self.objects_to_num = {}
-        self.__repr__ = self.__str__
+class UnionFind(object):
+    """Represents disjoint sets of hashable objects.
+
+    Objects are numbered in the insertion order, and the sets are kept
+    in integer arrays of parents and sizes with union by size and path
+    halving.
+    """
+
+    __slots__ = ('_parents', '_sizes', '_objects', '_ids')
+
+    def __init__(self, objects=()):
+        self._parents = array('i')
+        self._sizes = array('i')
+        self._objects = []
+        self._ids = {}
+        self.insert_objects(objects)
+
+    def __len__(self):
+        return len(self._objects)
+
     def insert_objects(self, objects):
-        '''\
-Insert a sequence of objects into the structure.  All must be Python hashable.'''
+        """Inserts a sequence of objects, each of which becomes its own set
+        unless it is known.
+        """
         for object in objects:
-            self.find(object);
+            self._id(object)
+
     def find(self, object):
-        '''\
-Find the root of the set that an object is in.
-If the object was not known, will make it known, and it becomes its own set.
-Object must be Python hashable.'''
-        if not object in self.objects_to_num:
-            obj_num = len(self.objects_to_num)
-            self.num_weights[obj_num] = 1
-            self.objects_to_num[object] = obj_num
-            self.num_to_objects[obj_num] = object
-            self.parent_pointers[obj_num] = obj_num
-            return object
-        stk = [self.objects_to_num[object]]
-        par = self.parent_pointers[stk[-1]]
-        while par != stk[-1]:
-            stk.append(par)
-            par = self.parent_pointers[par]
-        for i in stk:
-            self.parent_pointers[i] = par
-        return self.num_to_objects[par]
+        """Returns the representative object of the set the object is in.
+
+        If the object is not known, it becomes its own set.
+        """
+        return self._objects[self._root(self._id(object))]
+
     def union(self, object1, object2):
-        '''\
-Combine the sets that contain the two objects given.
-Both objects must be Python hashable.
-If either or both objects are unknown, will make them known, and combine them.'''
-        o1p = self.find(object1)
-        o2p = self.find(object2)
-        if o1p != o2p:
-            on1 = self.objects_to_num[o1p]
-            on2 = self.objects_to_num[o2p]
-            w1 = self.num_weights[on1]
-            w2 = self.num_weights[on2]
-            if w1 < w2:
-                o1p, o2p, on1, on2, w1, w2 = o2p, o1p, on2, on1, w2, w1
-            self.num_weights[on1] = w1+w2
-            del self.num_weights[on2]
-            self.parent_pointers[on2] = on1
+        """Combines the sets that contain the two objects.
+        """
+        self._union(self._id(object1), self._id(object2))
+
+    def union_pairs(self, objects1, objects2):
+        """Combines the sets of objects1[k] and objects2[k] for each k.
+        """
+        ids = self._ids
+        for o1, o2 in zip(objects1, objects2):
+            i = ids[o1] if o1 in ids else self._id(o1)
+            j = ids[o2] if o2 in ids else self._id(o2)
+            self._union(i, j)
+
+    def labels(self):
+        """Returns an array of set IDs for all the objects.
+
+        The i-th item is for the i-th inserted object, and sets are
+        numbered from 0 in the order of their first objects.
+        """
+        parents = self._parents
+        labels = array('i', [-1]) * len(parents)
+        n = 0
+        for i in range(len(parents)):
+            r = self._root(i)
+            if labels[r] < 0:
+                labels[r] = n
+                n += 1
+            labels[i] = labels[r]
+        return labels
+
+    def _id(self, object):
+        i = self._ids.get(object)
+        if i is None:
+            i = len(self._objects)
+            self._ids[object] = i
+            self._objects.append(object)
+            self._parents.append(i)
+            self._sizes.append(1)
+        return i
+
+    def _root(self, i):
+        parents = self._parents
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def _union(self, i, j):
+        i = self._root(i)
+        j = self._root(j)
+        if i != j:
+            if self._sizes[i] < self._sizes[j]:
+                i, j = j, i
+            self._parents[j] = i
+            self._sizes[i] += self._sizes[j]
+
     def __str__(self):
-        '''\
-Included for testing purposes only.
-All information needed from the union find data structure can be attained
-using find.'''
         sets = {}
-        for i in range(len(self.objects_to_num)):
-            sets[i] = []
-        for i in self.objects_to_num:
-            sets[self.objects_to_num[self.find(i)]].append(i)
-        out = []
-        for i in sets.values():
-            if i:
-                out.append(repr(i))
-        return ', '.join(out)
+        for object, label in zip(self._objects, self.labels()):
+            sets.setdefault(label, []).append(object)
+        return ', '.join([repr(sets[l]) for l in sorted(sets)])
+
+    __repr__ = __str__
 
 
 if __name__ == '__main__':
@@ -152,7 +187,7 @@ if __name__ == '__main__':
     uf.insert_objects(az)
     import random
     cnt = 0
-    while len(uf.num_weights) > 20:
+    while len(set(uf.labels())) > 20:
         cnt += 1
         uf.union(random.choice(az), random.choice(az))
     print(uf, cnt)
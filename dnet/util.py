@@ -20,41 +20,75 @@
 """Utility functions for DNET.
 """
 
+from array import array
+from dnet.unionfind import UnionFind
+
+
 def flatten(L):
-    if isinstance(L, (list, tuple, set)):
-        if isinstance(L, (tuple, set)):
-            L = list(L)
-        if L == []:
-            return L
-        else:
-            return flatten(L[0]) + flatten(L[1:])
-    else:
+    """Flattens nested lists, tuples, and sets into a list.
+
+    Nested items are visited with an explicit stack, so that deep or
+    long lists are flattened in linear time.
+    """
+    if not isinstance(L, (list, tuple, set)):
         return [L]
+    flat = []
+    stack = [iter(list(L))]
+    while stack:
+        for x in stack[-1]:
+            if isinstance(x, (list, tuple, set)):
+                stack.append(iter(list(x)))
+                break
+            flat.append(x)
+        else:
+            stack.pop()
+    return flat
 
 
 def is_tree(branches):
     """Test if branches form a tree.
 
-    This method is inspired by networkx.algorithms.cycles
+    Branches are regarded as undirected edges, and duplicated ones are
+    merged.  The test is false if a cycle is found by union-find in
+    almost linear time.
     """
-    gnodes = set(flatten(branches))
-    while gnodes:
-        root = gnodes.pop()
-        stack = [root]
-        pred = { root: root }
-        used = { root: set() }
-        while stack:
-            z = stack.pop()
-            zused = used[z]
-            nbrs = set([e[1] for e in branches
-                        if e[0] == z] + [e[0] for e in branches if e[1] == z])
-            for nbr in nbrs:
-                if nbr not in used:
-                    pred[nbr] = z
-                    stack.append(nbr)
-                    used[nbr] = set([z])
-                elif nbr not in zused:
-                    return False
-        gnodes -= set(pred)
-        root = None
+    uf = UnionFind()
+    for e in set([frozenset(e) for e in branches]):
+        if len(e) == 1:
+            return False  # a self loop
+        u, v = e
+        if uf.find(u) == uf.find(v):
+            return False
+        uf.union(u, v)
     return True
+
+
+def csr(lists):
+    """Packs lists of integers into compressed sparse row arrays.
+
+    Returns a tuple of pointer and data arrays, in which the i-th list
+    is stored as data[ptr[i]:ptr[i + 1]].
+    """
+    ptr = array('i', [0])
+    data = array('i')
+    for l in lists:
+        data.extend(l)
+        ptr.append(len(data))
+    return ptr, data
+
+
+if __name__ == '__main__':
+    # microbenchmark over random trees
+    import random
+    import time
+    for n in (10**3, 10**4, 10**5):
+        branches = [(random.randrange(i), i) for i in range(1, n + 1)]
+        random.shuffle(branches)
+        t = time.time()
+        assert is_tree(branches)
+        assert not is_tree(branches + [(0, n)])
+        t1 = time.time() - t
+        t = time.time()
+        assert len(flatten(branches)) == 2 * n
+        t2 = time.time() - t
+        print('%6d branches: is_tree %.3f sec, flatten %.3f sec' % (n, t1, t2))
@@ -19,8 +19,6 @@ operation such as loss minimization and service restoration.
         'Operating System :: POSIX :: Linux',
         'Operating System :: POSIX :: BSD :: FreeBSD',
         'Operating System :: MacOS :: MacOS X',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
@@ -34,5 +32,6 @@ operation such as loss minimization and service restoration.
       license=release.license,
       packages=['dnet'],
       install_requires=['graphillion', 'networkx', 'pyyaml'],
+      python_requires='>=3.4',
       test_suite='dnet.test',
       )